@@ -17,7 +17,8 @@ class CFNegGenerator(CFGenerator):
     def generate(self, users, items, kg_neighbors, all_candidates,
                  user_all_embeddings=None, entity_all_embeddings=None,
                  item_embeddings=None):
-        neighbors = kg_neighbors[items]  # (batch, n_cans)
+        # the shared table is int32 storage, indices must be int64
+        neighbors = kg_neighbors[items].long()  # (batch, n_cans)
         batch_size = users.shape[0]
         batch_tensor = torch.arange(batch_size, device=self.device)
         batch_tensor2 = torch.arange(batch_size * self.replace_num, device=self.device)
@@ -47,5 +47,5 @@ class CFGenerator(nn.Module):
     @staticmethod
     def get_cf_kg_neighbors(kg_neighbors, batch_tensor, indices, values):
         cf_kg_neighbors = kg_neighbors.clone()
-        cf_kg_neighbors[batch_tensor.unsqueeze(1), indices] = values
+        cf_kg_neighbors[batch_tensor.unsqueeze(1), indices] = values.to(cf_kg_neighbors.dtype)
         return cf_kg_neighbors
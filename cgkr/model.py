@@ -4,6 +4,13 @@
 # @Email  : slmu@ruc.edu.cn
 
 
+import functools
+import hashlib
+import os
+import tempfile
+import zipfile
+from logging import getLogger
+
 import torch
 import torch.nn as nn
 import numpy as np
@@ -16,23 +23,68 @@ from recbole.model.init import xavier_normal_initialization
 
 
 def norm_adj(adj):
+    adj = sp.coo_matrix(adj)
     sum_arr = (adj > 0).sum(axis=1)
     diag = np.array(sum_arr.flatten())[0] + 1e-7
     diag = np.power(diag, -0.5)
-    d = sp.diags(diag)
-    laplace_adj = d * adj * d
+    # D^-1/2 * A * D^-1/2 scales every nnz by diag[row] * diag[col]
+    data = adj.data * diag[adj.row] * diag[adj.col]
+    laplace_adj = sp.coo_matrix((data.astype(np.float32), (adj.row, adj.col)),
+                                shape=adj.shape)
     return laplace_adj
 
 
 def convert_to_tensor(laplace_adj):
-    laplace_adj = sp.coo_matrix(laplace_adj)
-    index = torch.LongTensor([laplace_adj.row, laplace_adj.col])
-    data = torch.FloatTensor(laplace_adj.data)
-    sparse_laplace_adj = torch.sparse.FloatTensor(
-        index, data, torch.Size(laplace_adj.shape))
+    laplace_adj = sp.csr_matrix(laplace_adj, dtype=np.float32)
+    laplace_adj.sum_duplicates()
+    # CSR SpMM is much faster than COO SpMM for the propagation in through_graph,
+    # and int32 indices hit the cuSPARSE fast path with half the index traffic
+    sparse_laplace_adj = torch.sparse_csr_tensor(
+        torch.from_numpy(laplace_adj.indptr.astype(np.int32)),
+        torch.from_numpy(laplace_adj.indices.astype(np.int32)),
+        torch.from_numpy(laplace_adj.data), torch.Size(laplace_adj.shape))
     return sparse_laplace_adj
 
 
+# bump whenever the content of cached adjacencies changes
+ADJ_CACHE_VERSION = 1
+
+
+def get_cache_file(cache_dir, name, *arrays):
+    md5 = hashlib.md5('{}-v{}'.format(name, ADJ_CACHE_VERSION).encode())
+    for array in arrays:
+        md5.update(np.ascontiguousarray(array).tobytes())
+    return os.path.join(cache_dir, '{}-{}.npz'.format(name, md5.hexdigest()))
+
+
+def save_cache_file(cache_file, adj):
+    # write to a temporary file first so concurrent runs never load a partial file
+    cache_dir = os.path.dirname(cache_file)
+    f = tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False)
+    try:
+        with f:
+            sp.save_npz(f, adj)
+        # NamedTemporaryFile creates 0600 files, give the cache the usual umask
+        # mode so other users sharing the dataset directory can read it
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(f.name, 0o666 & ~umask)
+        os.replace(f.name, cache_file)
+    except BaseException:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+        raise
+
+
+def autocast(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                            enabled=self.mixed_precision):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 class CGKR(KnowledgeRecommender):
 
     input_type = InputType.PAIRWISE
@@ -48,122 +100,208 @@ class CGKR(KnowledgeRecommender):
         self.cf_pos_flag = config['cf_pos_flag']
         self.cf_neg_flag = config['cf_neg_flag']
         self.max_neighbor_size = config['max_neighbor_size']
+        self.dense_threshold = config['dense_threshold']
         self.cf_loss_function = config['cf_loss_function']
         self.cf_pos_weight = config['cf_pos_weight']
         self.cf_neg_weight = config['cf_neg_weight']
 
         self.ib_beta = config['ib_beta']
+        self.logger = getLogger()
+        self.cache_adj = config['cache_adj']
+        self.data_path = config['data_path']
+        self.mixed_precision = bool(config['mixed_precision'])
 
         # load dataset info
         self.ui_graph = dataset.inter_matrix(form='coo').astype(np.float32)
 
         # generate intermediate data
-        self.ui_adj = self.get_ui_adj(self.ui_graph).to(self.device)
+        self.ui_adj, self.iu_adj = self.get_ui_adj(self.ui_graph)
+        self.ui_adj, self.iu_adj = self.ui_adj.to(self.device), self.iu_adj.to(self.device)
         self.kg_adj = self.get_kg_adj(raw_kg_neighbors).to(self.device)
+        # shared with the trainer and generators, stored as int32 to halve its
+        # footprint and widened to int64 wherever it is used as an index
+        self.raw_kg_neighbors = torch.from_numpy(
+            np.asarray(raw_kg_neighbors, dtype=np.int32)).to(self.device)
+        self.hop_sizes = [self.max_neighbor_size ** hop
+                          for hop in range(self.n_kg_layers + 1)]
+        self.hop_weights = self.get_hop_weights().to(self.device)
 
         # define layers and loss
-        self.user_embedding = nn.Embedding(self.n_users, self.embedding_size,
-                                           padding_idx=0)
-        self.entity_embedding = nn.Embedding(self.n_entities, self.embedding_size,
-                                             padding_idx=0)
+        self.user_embedding = nn.Embedding(self.n_users, self.embedding_size)
+        self.entity_embedding = nn.Embedding(self.n_entities, self.embedding_size)
         self.bpr_loss = BPRLoss()
         self.mae_loss = nn.L1Loss()
         self.restore_user_e = None
         self.restore_item_e = None
+        self.restore_item_e_t = None
+        self.forward_cache = None
 
         # parameters initialization
         self.apply(xavier_normal_initialization)
         self.entity_embedding.weight.data[0].fill_(0)
         self.user_embedding.weight.data[0].fill_(0)
 
+        # fuse the small gather/reshape/mean kernels (requires PyTorch 2.0)
+        if config['torch_compile']:
+            self.through_graph = torch.compile(self.through_graph, dynamic=False)
+            self.get_cf_i_embeddings = torch.compile(self.get_cf_i_embeddings,
+                                                     dynamic=False)
+
     def get_ui_adj(self, ui_graph):
+        cache_file, laplace_adj = None, None
+        if self.cache_adj:
+            cache_file = get_cache_file(self.data_path, 'ui_adj', np.array(ui_graph.shape),
+                                        ui_graph.row, ui_graph.col)
+        # the cache is only a speed-up, any failure falls back to building the graph
+        if cache_file is not None and os.path.isfile(cache_file):
+            try:
+                laplace_adj = sp.load_npz(cache_file)
+            except (OSError, ValueError, EOFError, zipfile.BadZipFile) as e:
+                self.logger.warning('Failed to load adjacency cache {}: {}'.format(cache_file, e))
+        if laplace_adj is None:
+            laplace_adj = self.get_ui_laplace_adj(ui_graph)
+            if cache_file is not None:
+                try:
+                    save_cache_file(cache_file, laplace_adj)
+                except OSError as e:
+                    self.logger.warning('Failed to save adjacency cache {}: {}'.format(cache_file, e))
+
+        # the graph is bipartite, only the off-diagonal blocks are non-zero
+        ui_adj = convert_to_tensor(laplace_adj[:self.n_users, self.n_users:])
+        iu_adj = convert_to_tensor(laplace_adj[self.n_users:, :self.n_users])
+        return ui_adj, iu_adj
+
+    def get_ui_laplace_adj(self, ui_graph):
         ui_graph_t = ui_graph.transpose()
-        adj = sp.dok_matrix((self.n_users + self.n_items,
-                             self.n_users + self.n_items), dtype=np.float32)
-        data_dict = dict(zip(
-            zip(ui_graph.row, ui_graph.col + self.n_users), [1] * ui_graph.nnz))
-        data_dict.update(dict(zip(
-            zip(ui_graph_t.row + self.n_users, ui_graph_t.col), [1] * ui_graph_t.nnz)))
-        adj._update(data_dict)
+        row = np.concatenate([ui_graph.row, ui_graph_t.row + self.n_users])
+        col = np.concatenate([ui_graph.col + self.n_users, ui_graph_t.col])
+        data = np.ones(len(row), dtype=np.float32)
+        adj = sp.coo_matrix((data, (row, col)), shape=(self.n_users + self.n_items,
+                                                       self.n_users + self.n_items))
+        # repeated interactions are kept as a single edge of weight 1
+        adj.sum_duplicates()
+        adj.data[:] = 1.
         laplace_adj = norm_adj(adj)
-        sparse_laplace_adj = convert_to_tensor(laplace_adj)
-        return sparse_laplace_adj
+        return sp.csr_matrix(laplace_adj)
 
     def get_kg_adj(self, kg_neighbors):
-        adj = sp.dok_matrix((self.n_entities, self.n_entities), dtype=np.float32)
-        data_row, data_col = [], []
-        for i in range(self.n_entities):
-            for c in kg_neighbors[i]:
-                if c != 0:
-                    data_row.append(i)
-                    data_col.append(c)
-        data_dict = dict(zip(
-            zip(data_row, data_col), [1. / self.max_neighbor_size] * len(data_row)))
-        adj._update(data_dict)
+        kg_neighbors = np.asarray(kg_neighbors, dtype=np.int64)
+        row = np.repeat(np.arange(self.n_entities), kg_neighbors.shape[1])
+        col = kg_neighbors[:self.n_entities].reshape(-1)
+        mask = col != 0
+        data = np.ones(mask.sum(), dtype=np.float32)
+        adj = sp.csr_matrix((data, (row[mask], col[mask])),
+                            shape=(self.n_entities, self.n_entities))
+        # repeated neighbors are kept as a single edge
+        adj.data[:] = 1.
+        # dense GEMM beats SpMM once the KG is dense enough
+        if self.dense_threshold is not None and \
+                adj.nnz / self.n_entities ** 2 > self.dense_threshold:
+            return torch.from_numpy(adj.toarray())
         sparse_adj = convert_to_tensor(adj)
         return sparse_adj
 
     @staticmethod
-    def through_graph(adj, all_embeddings, n_layers):
-        all_embeddings_list = [all_embeddings]
+    def through_graph(adj, all_embeddings, n_layers, scale=1.):
+        # a uniform edge weight is applied to the output instead of every nnz
+        mm = torch.mm if adj.layout == torch.strided else torch.sparse.mm
+        embeddings_sum = all_embeddings
+        for layer_idx in range(n_layers):
+            all_embeddings = mm(adj, all_embeddings)
+            if scale != 1.:
+                all_embeddings = all_embeddings * scale
+            embeddings_sum = embeddings_sum + all_embeddings
+        return embeddings_sum / (n_layers + 1)
+
+    def through_bipartite_graph(self, user_embeddings, item_embeddings, n_layers):
+        # same as through_graph on the full ui-graph, without concatenating
+        # users and items; only the user side of the output is needed
+        user_embeddings_sum = user_embeddings
         for layer_idx in range(n_layers):
-            all_embeddings = torch.sparse.mm(adj, all_embeddings)
-            all_embeddings_list.append(all_embeddings)
-        all_embeddings = torch.stack(all_embeddings_list, dim=1)
-        all_embeddings = torch.mean(all_embeddings, dim=1)
-        return all_embeddings
+            next_user_embeddings = torch.sparse.mm(self.ui_adj, item_embeddings)
+            if layer_idx < n_layers - 1:
+                item_embeddings = torch.sparse.mm(self.iu_adj, user_embeddings)
+            user_embeddings = next_user_embeddings
+            user_embeddings_sum = user_embeddings_sum + user_embeddings
+        return user_embeddings_sum / (n_layers + 1)
 
+    def invalidate_cache(self):
+        self.forward_cache = None
+
+    @autocast
     def forward(self):
+        # without autograd (generator training, evaluation) reuse the propagated
+        # embeddings until the parameters change; this relies on the private
+        # Tensor._version counter, which optimizer steps and load_state_dict bump
+        use_cache = not torch.is_grad_enabled()
+        cache_key = (self.user_embedding.weight._version,
+                     self.entity_embedding.weight._version)
+        if use_cache and self.forward_cache is not None \
+                and self.forward_cache[0] == cache_key:
+            return self.forward_cache[1]
+
         # through kg
         entity_embeddings = self.entity_embedding.weight
         entity_embeddings = self.through_graph(
-            self.kg_adj, entity_embeddings, self.n_kg_layers)
+            self.kg_adj, entity_embeddings, self.n_kg_layers,
+            scale=1. / self.max_neighbor_size)
 
         # through ui-graph
         item_embeddings = entity_embeddings[:self.n_items]
         user_embeddings = self.user_embedding.weight
-        ui_embeddings = torch.cat([user_embeddings, item_embeddings], dim=0)
-        ui_embeddings = self.through_graph(
-            self.ui_adj, ui_embeddings, self.n_ui_layers)
-        user_embeddings, _ = torch.split(ui_embeddings, [self.n_users, self.n_items])
+        user_embeddings = self.through_bipartite_graph(
+            user_embeddings, item_embeddings, self.n_ui_layers)
 
+        if use_cache:
+            self.forward_cache = (cache_key, (user_embeddings, entity_embeddings))
         return user_embeddings, entity_embeddings
 
+    def get_hop_weights(self):
+        # mean over the entities of each hop, then mean over hops
+        hop_weights = [torch.full((size,), 1. / (size * len(self.hop_sizes)))
+                       for size in self.hop_sizes]
+        return torch.cat(hop_weights)
+
     def get_batch_neighbors(self, items, kg_neighbors):
         batch_size = items.shape[0]
-        entities = [items.unsqueeze(1)]
-        for i in range(self.n_kg_layers):
-            entities.append(kg_neighbors[entities[i]].view(batch_size, -1))
+        entities = torch.empty((batch_size, sum(self.hop_sizes)),
+                               dtype=torch.long, device=items.device)
+        entities[:, 0] = items
+        start = 0
+        for hop in range(self.n_kg_layers):
+            end = start + self.hop_sizes[hop]
+            entities[:, end:end + self.hop_sizes[hop + 1]] = \
+                kg_neighbors[entities[:, start:end]].view(batch_size, -1)
+            start = end
         return entities
 
     def get_cf_i_embeddings(self, items, kg_neighbors):
-        batch_size = items.shape[0]
         entities = self.get_batch_neighbors(items, kg_neighbors)
-        entity_vectors = [self.entity_embedding(i) for i in entities]
-        item_embeddings_list = [entity_vectors[0].squeeze()]
-
-        for i in range(self.n_kg_layers):
-            entity_vectors_next_iter = []
-            for hop in range(self.n_kg_layers - i):
-                shape = (batch_size, -1, self.max_neighbor_size, self.embedding_size)
-                neighbor_vectors = torch.reshape(entity_vectors[hop + 1], shape)
-                neighbor_vectors = torch.mean(neighbor_vectors, dim=2)
-                entity_vectors_next_iter.append(neighbor_vectors)
-            entity_vectors = entity_vectors_next_iter
-            item_embeddings_list.append(entity_vectors[0].squeeze())
-        item_embeddings = torch.stack(item_embeddings_list, dim=1)
-        item_embeddings = torch.mean(item_embeddings, dim=1)
+        # the neighbor trees are full, so the layer-wise aggregation of hop h
+        # equals the plain mean over all its max_neighbor_size ** h entities
+        entity_vectors = self.entity_embedding(entities)
+        # padding entities (id 0) are masked out of the weights, which also
+        # keeps gradients away from the padding row
+        hop_weights = self.hop_weights * (entities != 0)
+        item_embeddings = torch.einsum('bn,bnd->bd', hop_weights, entity_vectors)
 
         return item_embeddings
 
+    @staticmethod
+    def get_scores(u_embeddings, i_embeddings):
+        # fused row-wise dot product, no (batch, embed) intermediate
+        return torch.einsum('bd,bd->b', u_embeddings, i_embeddings)
+
     def get_bpr_loss(self, pos_scores, neg_scores):
         bpr_loss = self.bpr_loss(pos_scores, neg_scores)
         return bpr_loss
 
+    @autocast
     def calculate_loss(self, interaction,
                        user_all_embeddings=None, entity_all_embeddings=None):
         if self.restore_user_e is not None or self.restore_item_e is not None:
             self.restore_user_e, self.restore_item_e = None, None
+            self.restore_item_e_t = None
 
         users = interaction[self.USER_ID]
         pos_items = interaction[self.ITEM_ID]
@@ -176,8 +314,8 @@ class CGKR(KnowledgeRecommender):
         posi_embeddings = entity_all_embeddings[pos_items]
         negi_embeddings = entity_all_embeddings[neg_items]
 
-        pos_scores = torch.mul(u_embeddings, posi_embeddings).sum(dim=1)
-        neg_scores = torch.mul(u_embeddings, negi_embeddings).sum(dim=1)
+        pos_scores = self.get_scores(u_embeddings, posi_embeddings)
+        neg_scores = self.get_scores(u_embeddings, negi_embeddings)
 
         # BPR Loss
         bpr_loss = self.get_bpr_loss(pos_scores, neg_scores)
@@ -188,7 +326,7 @@ class CGKR(KnowledgeRecommender):
         if self.cf_pos_flag:
             cf_posi_embeddings = self.get_cf_i_embeddings(
                 pos_items, interaction['cf_pos_kg_neighbors'])
-            cf_pos_scores = torch.mul(u_embeddings, cf_posi_embeddings).sum(dim=1)
+            cf_pos_scores = self.get_scores(u_embeddings, cf_posi_embeddings)
             if self.cf_loss_function == 'mae':
                 cf_pos_loss = self.mae_loss(pos_scores, cf_pos_scores)
             else:
@@ -197,7 +335,7 @@ class CGKR(KnowledgeRecommender):
         if self.cf_neg_flag:
             cf_negi_embeddings = self.get_cf_i_embeddings(
                 neg_items, interaction['cf_neg_kg_neighbors'])
-            cf_neg_scores = torch.mul(u_embeddings, cf_negi_embeddings).sum(dim=1)
+            cf_neg_scores = self.get_scores(u_embeddings, cf_negi_embeddings)
             if self.cf_loss_function == 'mae':
                 cf_neg_loss = self.mae_loss(neg_scores, cf_neg_scores)
             else:
@@ -206,18 +344,20 @@ class CGKR(KnowledgeRecommender):
 
         return tuple(losses)
 
+    @autocast
     def full_sort_predict(self, interaction):
         if self.restore_user_e is None or self.restore_item_e is None:
             self.restore_user_e, restore_entity_e = self.forward()
             self.restore_item_e = restore_entity_e[:self.n_items]
+            # materialize the transpose once so every batch runs a plain NN GEMM
+            self.restore_item_e_t = self.restore_item_e.t().contiguous()
 
         user = interaction[self.USER_ID]
         # get user embedding from storage variable
         u_embeddings = self.restore_user_e[user]
 
         # dot with all item embedding to accelerate
-        scores = torch.matmul(
-            u_embeddings, self.restore_item_e.transpose(0, 1))
+        scores = torch.matmul(u_embeddings, self.restore_item_e_t)
 
         return scores.view(-1)
 
@@ -238,6 +378,7 @@ class CGKR(KnowledgeRecommender):
         reward = torch.log(gamma + torch.sigmoid(scores1 - scores2))
         return reward
 
+    @autocast
     def generate_pos_reward(self, interaction, kg_neighbors1, kg_neighbors2,
                             user_all_embeddings, entity_all_embeddings):
         users = interaction[self.USER_ID]
@@ -246,21 +387,22 @@ class CGKR(KnowledgeRecommender):
         u_embeddings = user_all_embeddings[users]
         posi_embeddings = entity_all_embeddings[pos_items]
         negi_embeddings = entity_all_embeddings[neg_items]
-        pos_scores = torch.mul(u_embeddings, posi_embeddings).sum(dim=1)
-        neg_scores = torch.mul(u_embeddings, negi_embeddings).sum(dim=1)
+        pos_scores = self.get_scores(u_embeddings, posi_embeddings)
+        neg_scores = self.get_scores(u_embeddings, negi_embeddings)
 
         # generate reward1
         cf_posi_embeddings1 = self.get_cf_i_embeddings(pos_items, kg_neighbors1)
-        cf_pos_scores1 = torch.mul(u_embeddings, cf_posi_embeddings1).sum(dim=1)
+        cf_pos_scores1 = self.get_scores(u_embeddings, cf_posi_embeddings1)
         reward1 = self.get_reward1(cf_pos_scores1, neg_scores, cf_posi_embeddings1)
 
         # generate reward2
         cf_posi_embeddings2 = self.get_cf_i_embeddings(pos_items, kg_neighbors2)
-        cf_pos_scores2 = torch.mul(u_embeddings, cf_posi_embeddings2).sum(dim=1)
+        cf_pos_scores2 = self.get_scores(u_embeddings, cf_posi_embeddings2)
         reward2 = self.get_reward2(pos_scores, cf_pos_scores2)
 
         return reward1, reward2
 
+    @autocast
     def generate_neg_reward(self, interaction, kg_neighbors1, kg_neighbors2,
                             user_all_embeddings, entity_all_embeddings):
         users = interaction[self.USER_ID]
@@ -269,17 +411,17 @@ class CGKR(KnowledgeRecommender):
         u_embeddings = user_all_embeddings[users]
         posi_embeddings = entity_all_embeddings[pos_items]
         negi_embeddings = entity_all_embeddings[neg_items]
-        pos_scores = torch.mul(u_embeddings, posi_embeddings).sum(dim=1)
-        neg_scores = torch.mul(u_embeddings, negi_embeddings).sum(dim=1)
+        pos_scores = self.get_scores(u_embeddings, posi_embeddings)
+        neg_scores = self.get_scores(u_embeddings, negi_embeddings)
 
         # generate reward1
         cf_negi_embeddings1 = self.get_cf_i_embeddings(neg_items, kg_neighbors1)
-        cf_neg_scores1 = torch.mul(u_embeddings, cf_negi_embeddings1).sum(dim=1)
+        cf_neg_scores1 = self.get_scores(u_embeddings, cf_negi_embeddings1)
         reward1 = self.get_reward1(pos_scores, cf_neg_scores1, cf_negi_embeddings1)
 
         # generate reward2
         cf_negi_embeddings2 = self.get_cf_i_embeddings(neg_items, kg_neighbors2)
-        cf_neg_scores2 = torch.mul(u_embeddings, cf_negi_embeddings2).sum(dim=1)
+        cf_neg_scores2 = self.get_scores(u_embeddings, cf_negi_embeddings2)
         reward2 = self.get_reward2(cf_neg_scores2, neg_scores)
 
         return reward1, reward2
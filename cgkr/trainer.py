@@ -3,6 +3,8 @@
 # @Author : Shanlei Mu
 # @Email  : slmu@ruc.edu.cn
 
+import contextlib
+
 import torch
 import torch.optim as optim
 import numpy as np
@@ -13,7 +15,7 @@ from recbole.utils import KGDataLoaderState
 
 class CFTrainer(Trainer):
 
-    def __init__(self, config, dataset, rec_model, raw_kg_neighbors,
+    def __init__(self, config, dataset, rec_model,
                  cf_pos_generator=None, cf_neg_generator=None):
         super(CFTrainer, self).__init__(config, rec_model)
 
@@ -39,9 +41,13 @@ class CFTrainer(Trainer):
         self.n_items = dataset.num(self.ITEM_ID)
         self.n_entities = dataset.num(self.ENTITY_ID)
         self.n_relations = dataset.num(self.RELATION_ID)
-        self.kg_neighbors = torch.from_numpy(raw_kg_neighbors).to(self.device)
+        self.kg_neighbors = self.model.raw_kg_neighbors
         self.r2candidates = dataset.relation2candidates()
 
+        # the pos generator runs on a side stream, overlapping the neg generator
+        self.gen_stream = torch.cuda.Stream(self.device) \
+            if self.device.type == 'cuda' and self.cf_pos_flag and self.cf_neg_flag else None
+
         # init generator and optimizer
         if self.cf_pos_flag:
             self.cf_pos_generator = cf_pos_generator
@@ -69,6 +75,21 @@ class CFTrainer(Trainer):
                 user_all_embeddings, entity_all_embeddings, item_embeddings)
         return kg_neighbors
 
+    def generator_stream(self):
+        if self.gen_stream is None:
+            return contextlib.nullcontext()
+        # inputs are produced on the current stream
+        self.gen_stream.wait_stream(torch.cuda.current_stream(self.device))
+        return torch.cuda.stream(self.gen_stream)
+
+    def sync_generator_stream(self, *tensors):
+        if self.gen_stream is None:
+            return
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.gen_stream)
+        for tensor in tensors:
+            tensor.record_stream(current_stream)
+
     def calculate_generator_loss(self, interaction, user_all_embeddings,
                                  entity_all_embeddings, flag='pos'):
         if flag == 'pos':
@@ -122,21 +143,25 @@ class CFTrainer(Trainer):
                 with torch.no_grad():
                     # Generate cf kg
                     if self.cf_pos_flag:
-                        kg_neighbors = self.generate_cf_kg(
-                            interaction, user_all_embeddings, entity_all_embeddings,
-                            flag='pos')
-                        interaction.interaction['cf_pos_kg_neighbors'] = kg_neighbors
+                        with self.generator_stream():
+                            pos_kg_neighbors = self.generate_cf_kg(
+                                interaction, user_all_embeddings, entity_all_embeddings,
+                                flag='pos')
                     if self.cf_neg_flag:
                         kg_neighbors = self.generate_cf_kg(
                             interaction, user_all_embeddings, entity_all_embeddings,
                             flag='neg')
                         interaction.interaction['cf_neg_kg_neighbors'] = kg_neighbors
+                    if self.cf_pos_flag:
+                        self.sync_generator_stream(pos_kg_neighbors)
+                        interaction.interaction['cf_pos_kg_neighbors'] = pos_kg_neighbors
                 losses = self.model.calculate_loss(interaction, user_all_embeddings,
                                                    entity_all_embeddings)
                 loss = sum(losses)
                 self._check_nan(loss)
                 loss.backward()
                 self.optimizer.step()
+                self.model.invalidate_cache()
                 loss_tuple = tuple(per_loss.item() for per_loss in losses)
                 total_base_loss = loss_tuple if total_base_loss is None else \
                     tuple(map(sum, zip(total_base_loss, loss_tuple)))
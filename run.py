@@ -50,7 +50,7 @@ def objective_function(config_dict=None, config_file_list=None, saved=True):
         logger.info(cf_neg_generator)
 
     # trainer initialization
-    trainer = CFTrainer(config, train_data, rec_model, raw_kg_neighbors,
+    trainer = CFTrainer(config, train_data, rec_model,
                         cf_pos_generator, cf_neg_generator)
     if config['pretrained_model_path']:
         trainer.resume_checkpoint(config['pretrained_model_path'])